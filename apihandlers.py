@@ -2,11 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import contextlib
+import contextvars
 import json
 import os
-from collections import deque
+import random
+import ssl
+import time
+import uuid
+from collections import deque, namedtuple
+from email.utils import parsedate_to_datetime
 
 import aiofiles
+import aiofiles.os
 import arrow
 import structlog
 import ujson
@@ -14,6 +22,719 @@ import aiohttp
 # import oauthlib.oauth1
 from yarl import URL
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+
+# Set while a login is running so requests made by the login itself never wait for it
+_inLogin = contextvars.ContextVar("inLogin", default=False)
+
+
+class JsonCodec:
+    ORJSON = "orjson"
+    UJSON = "ujson"
+    STDLIB = "json"
+
+    def __init__(self, name=None):
+        # Default to the fastest parser that is installed
+        if name is None:
+            name = self.ORJSON if orjson is not None else self.UJSON
+        if name == self.ORJSON and orjson is None:
+            raise ValueError("orjson is not installed")
+        if name not in (self.ORJSON, self.UJSON, self.STDLIB):
+            raise ValueError(f"unknown json codec {name}")
+        self.name = name
+
+    def loads(self, data):
+        # Accepts the raw response bytes as well as str
+        if self.name == self.ORJSON:
+            return orjson.loads(data)
+        if self.name == self.UJSON:
+            return ujson.loads(data)
+        return json.loads(data)
+
+    def dumps(self, obj):
+        if self.name == self.ORJSON:
+            return orjson.dumps(obj).decode("utf-8")
+        if self.name == self.UJSON:
+            return ujson.dumps(obj)
+        return json.dumps(obj)
+
+
+class RateLimiter:
+    log = structlog.get_logger(__name__)
+
+    SLIDING_WINDOW = "sliding"
+    TOKEN_BUCKET = "bucket"
+
+    def __init__(self, maxCalls, period, mode=SLIDING_WINDOW, name="RateLimiter"):
+        self.maxCalls = maxCalls
+        self.period = period
+        self.mode = mode
+        self.name = name
+
+        self._calls = deque()
+        self._tokens = float(maxCalls)
+        self._updated = time.monotonic()
+        self._blockedUntil = 0.0
+        # asyncio.Lock wakes its waiters in FIFO order
+        self._lock = asyncio.Lock()
+
+    def _prune(self, now):
+        while self._calls and now - self._calls[0] >= self.period:
+            self._calls.popleft()
+
+    def _refill(self, now):
+        self._tokens = min(float(self.maxCalls), self._tokens + (now - self._updated) * self.maxCalls / self.period)
+        self._updated = now
+
+    def timeUntilNextSlot(self):
+        now = time.monotonic()
+        self._prune(now)
+        delay = max(0.0, self._blockedUntil - now)
+
+        if self.mode == self.TOKEN_BUCKET:
+            self._refill(now)
+            if self._tokens < 1:
+                delay = max(delay, (1 - self._tokens) * self.period / self.maxCalls)
+
+        elif len(self._calls) >= self.maxCalls:
+            delay = max(delay, self._calls[0] + self.period - now)
+
+        return delay
+
+    def record(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._calls.append(now)
+        if self.mode == self.TOKEN_BUCKET:
+            self._refill(now)
+            self._tokens -= 1
+
+    async def acquire(self):
+        async with self._lock:
+            delay = self.timeUntilNextSlot()
+            while delay > 0:
+                self.log.info(f"{self.name} waiting {int(delay)} seconds due to rate limiting", calls=len(self._calls))
+                await asyncio.sleep(delay)
+                delay = self.timeUntilNextSlot()
+            self.record()
+
+    def penalize(self, seconds):
+        self._blockedUntil = max(self._blockedUntil, time.monotonic() + seconds)
+
+    def penaltyRemaining(self):
+        return max(0.0, self._blockedUntil - time.monotonic())
+
+    def snapshot(self):
+        # Call times as epoch seconds so they survive a restart
+        now = time.monotonic()
+        self._prune(now)
+        offset = time.time() - now
+        return [ts + offset for ts in self._calls]
+
+    def restore(self, timestamps):
+        now = time.monotonic()
+        offset = time.time() - now
+        self._calls.clear()
+        self._tokens = float(self.maxCalls)
+        self._updated = now - self.period
+        for ts in sorted(timestamps):
+            self.record(min(ts - offset, now))
+        self._prune(now)
+
+
+class ConnectivityMonitor:
+    log = structlog.get_logger(__name__)
+
+    _default = None
+
+    def __init__(self, probeUrl="http://google.com", ttl=60, retries=5, delay=5, timeout=5):
+        self.probeUrl = probeUrl
+        self.ttl = ttl
+        self.retries = retries
+        self.delay = delay
+        self.timeout = timeout
+
+        self.up = None
+        self.checkedAt = 0.0
+        self._lock = asyncio.Lock()
+        self._recheckTask = None
+
+    @classmethod
+    def default(cls):
+        # One monitor shared by every handler that doesn't bring its own
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def _fresh(self):
+        return self.up is not None and time.monotonic() - self.checkedAt < self.ttl
+
+    def reportSuccess(self):
+        # Any answer from a real request proves the network is up
+        self.up = True
+        self.checkedAt = time.monotonic()
+
+    def reportFailure(self):
+        # A failed request doesn't prove the network is down. Probe in the background so the
+        # retry isn't held up, the next real request updates the state as well
+        if self._recheckTask is None or self._recheckTask.done():
+            self._recheckTask = asyncio.create_task(self._recheck())
+
+    async def _recheck(self):
+        async with self._lock:
+            self.up = await self._probe()
+            self.checkedAt = time.monotonic()
+
+    async def isUp(self):
+        if self.up and self._fresh():
+            return True
+
+        # Concurrent callers share a single probe
+        async with self._lock:
+            if self._fresh():
+                return self.up
+            self.up = await self._probe()
+            self.checkedAt = time.monotonic()
+            return self.up
+
+    async def _probe(self):
+        for attempt in range(self.retries):
+            try:
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as _session:
+                    async with _session.get(self.probeUrl) as resp:
+                        if resp.status == 200:
+                            self.log.info("Internet connection is up")
+                            return True
+                        return False
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.log.warning(f"Attempt {attempt + 1}/{self.retries} failed; retrying in {self.delay} seconds...")
+                await asyncio.sleep(self.delay)
+
+        self.log.error("Failed to create session: network is unavailable.")
+        return False
+
+
+class CircuitBreaker:
+    log = structlog.get_logger(__name__)
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failureThreshold=3, resetTimeout=60, onStateChange=None):
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.onStateChange = onStateChange
+
+        self._state = self.CLOSED
+        self.failures = 0
+        self.openedAt = 0.0
+        self._trialStarted = None
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and time.monotonic() >= self.openedAt + self.resetTimeout:
+            self._transition(self.HALF_OPEN)
+        return self._state
+
+    def _transition(self, state):
+        if state == self._state:
+            return
+        old, self._state = self._state, state
+        self._trialStarted = None
+        if state == self.OPEN:
+            self.openedAt = time.monotonic()
+        self.log.info(f"{self.name} circuit {old} -> {state}", failures=self.failures)
+        if self.onStateChange is not None:
+            try:
+                self.onStateChange(self.name, old, state)
+            except Exception as e:
+                self.log.error(f"Exception in onStateChange", error=e)
+
+    def allowRequest(self):
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        # Half open lets a single trial request through, a stuck trial expires after resetTimeout
+        if state == self.HALF_OPEN and (self._trialStarted is None or time.monotonic() - self._trialStarted >= self.resetTimeout):
+            self._trialStarted = time.monotonic()
+            return True
+        return False
+
+    def recordSuccess(self):
+        self.failures = 0
+        self._transition(self.CLOSED)
+
+    def recordFailure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failureThreshold:
+            self._transition(self.OPEN)
+            # A new open period, wait the full resetTimeout again
+            self.openedAt = time.monotonic()
+
+    def remaining(self):
+        return max(0.0, self.openedAt + self.resetTimeout - time.monotonic()) if self._state == self.OPEN else 0.0
+
+
+class EndpointHealth:
+    log = structlog.get_logger(__name__)
+
+    def __init__(self, name, probe=None, startTask=None, failureThreshold=3, resetTimeout=60, onStateChange=None, alpha=0.2):
+        self.name = name
+        self.probe = probe
+        self.startTask = startTask or asyncio.create_task
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.onStateChange = onStateChange
+        self.alpha = alpha
+        self.endpoints = {}
+        self.breakers = {}
+        self._probes = {}
+
+    def _stats(self, url):
+        if url not in self.endpoints:
+            self.endpoints[url] = {"latency": None,
+                                   "errorRate": 0.0,
+                                   "throttleRate": 0.0}
+        return self.endpoints[url]
+
+    def breaker(self, url):
+        if url not in self.breakers:
+            self.breakers[url] = CircuitBreaker(f"{self.name} {url}", self.failureThreshold, self.resetTimeout, self._stateChanged)
+        return self.breakers[url]
+
+    def _stateChanged(self, name, old, new):
+        url = name[len(self.name) + 1:]
+        if new == CircuitBreaker.OPEN and (url not in self._probes or self._probes[url].done()):
+            self._probes[url] = self.startTask(self._probeLoop(url))
+        if self.onStateChange is not None:
+            self.onStateChange(self.name, url, old, new)
+
+    def _ewma(self, old, value):
+        return value if old is None else old + self.alpha * (value - old)
+
+    def recordResponse(self, url, latency, status):
+        stats = self._stats(url)
+        stats["latency"] = self._ewma(stats["latency"], latency)
+        stats["errorRate"] = self._ewma(stats["errorRate"], 1.0 if status >= 500 else 0.0)
+        stats["throttleRate"] = self._ewma(stats["throttleRate"], 1.0 if status == 429 else 0.0)
+        if status >= 500:
+            self.breaker(url).recordFailure()
+        else:
+            self.breaker(url).recordSuccess()
+
+    def recordFailure(self, url):
+        stats = self._stats(url)
+        stats["errorRate"] = self._ewma(stats["errorRate"], 1.0)
+        self.breaker(url).recordFailure()
+
+    async def _probeLoop(self, url):
+        # Probe an open endpoint in the background until it answers again
+        breaker = self.breaker(url)
+        while breaker.state != CircuitBreaker.CLOSED:
+            await asyncio.sleep(breaker.remaining())
+            if breaker.allowRequest():
+                if self.probe is None or await self.probe(url):
+                    breaker.recordSuccess()
+                else:
+                    breaker.recordFailure()
+            else:
+                await asyncio.sleep(1)
+
+    def available(self, url):
+        return self.breaker(url).state != CircuitBreaker.OPEN
+
+    def expectedLatency(self, url):
+        stats = self._stats(url)
+        # Endpoints without samples sort first so they get measured
+        if stats["latency"] is None:
+            return 0.0
+        return stats["latency"] * (1 + 4 * stats["errorRate"] + 4 * stats["throttleRate"])
+
+    def order(self, urls):
+        return sorted((url for url in urls if self.available(url)), key=self.expectedLatency)
+
+    def states(self):
+        return {url: breaker.state for url, breaker in self.breakers.items()}
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+class Deadline:
+
+    def __init__(self, timeout=None):
+        self.expires = time.monotonic() + timeout if timeout is not None else None
+
+    @classmethod
+    def of(cls, value):
+        # Accepts a Deadline, a timeout in seconds or None for no deadline
+        return value if isinstance(value, Deadline) else cls(value)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    async def sleep(self, delay):
+        # There is no point in sleeping past the deadline just to fail afterwards
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceeded()
+        await asyncio.sleep(delay)
+
+    async def run(self, awaitable):
+        remaining = self.remaining()
+        if remaining is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            # Request and socket timeouts surface here too, only ours is a deadline
+            # (the loop may fire the wait_for timer up to its clock resolution early)
+            if self.remaining() <= 0.001:
+                raise DeadlineExceeded()
+            raise
+
+
+Response = namedtuple("Response", "status content_type result url raw retryAfter")
+
+
+class JsonStream:
+    # Items at itemPath (ijson prefix notation, eg. "data.installation.eventLog.pagedList.item")
+    # are handed to the consumer while the body is still arriving, the rest of the document
+    # is built as usual and becomes the doSession result
+    log = structlog.get_logger(__name__)
+
+    def __init__(self, itemPath, maxBuffered=64):
+        self.itemPath = itemPath
+        self.queue = asyncio.Queue(maxsize=maxBuffered)
+        self.delivered = 0
+        self.result = None
+        self.task = None
+        self._index = 0
+
+    async def _put(self, item):
+        # A retried request parses the body again, items handed out by an earlier attempt are not repeated
+        if self._index >= self.delivered:
+            await self.queue.put(item)
+            self.delivered += 1
+        self._index += 1
+
+    async def consume(self, content, codec):
+        self._index = 0
+        if ijson is None:
+            return await self._consumeBuffered(await content.read(), codec)
+
+        skeleton = ObjectBuilder()
+        item = None
+        depth = 0
+        async for prefix, event, value in ijson.parse_async(content, use_float=True):
+            if item is None and prefix == self.itemPath:
+                if event not in ("start_map", "start_array"):
+                    await self._put(value)
+                    continue
+                item = ObjectBuilder()
+
+            if item is None:
+                skeleton.event(event, value)
+                continue
+
+            item.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                if depth == 0:
+                    await self._put(item.value)
+                    item = None
+
+        return skeleton.value
+
+    async def _consumeBuffered(self, raw, codec):
+        # Without ijson the body is parsed in one go, the items are still cut out of the result
+        document = codec.loads(raw)
+        *path, last = self.itemPath.split(".")
+        if last != "item":
+            path.append(last)
+        try:
+            parent = document
+            for key in path[:-1]:
+                parent = parent[key]
+            items = parent[path[-1]] if last == "item" else [parent[path[-1]]]
+            parent[path[-1]] = [] if last == "item" else None
+        except (KeyError, IndexError, TypeError):
+            return document
+
+        for item in items:
+            await self._put(item)
+        return document
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.queue.empty() and not self.task.done():
+            getter = asyncio.ensure_future(self.queue.get())
+            await asyncio.wait({getter, self.task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                return getter.result()
+            getter.cancel()
+
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+
+        self.result = self.task.result()
+        raise StopAsyncIteration
+
+    async def close(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+
+
+class RetryBudget:
+
+    def __init__(self, ratio=0.2, minRetries=10, period=60):
+        # Retries may add at most ratio of the requests made during period, on top of minRetries
+        self.ratio = ratio
+        self.minRetries = minRetries
+        self.period = period
+        self._requests = deque()
+        self._retries = deque()
+
+    def _prune(self, calls, now):
+        while calls and now - calls[0] >= self.period:
+            calls.popleft()
+
+    def recordRequest(self):
+        now = time.monotonic()
+        self._prune(self._requests, now)
+        self._requests.append(now)
+
+    def allowRetry(self):
+        now = time.monotonic()
+        self._prune(self._retries, now)
+        self._prune(self._requests, now)
+        if len(self._retries) >= self.minRetries + self.ratio * len(self._requests):
+            return False
+        self._retries.append(now)
+        return True
+
+
+class RetryPolicy:
+    FULL_JITTER = "full"
+    DECORRELATED_JITTER = "decorrelated"
+
+    def __init__(self, maxAttempts=5, base=1, cap=60, jitter=FULL_JITTER, honourRetryAfter=True, budget=None, floor=0):
+        self.maxAttempts = maxAttempts
+        self.base = base
+        self.cap = cap
+        self.floor = floor
+        self.jitter = jitter
+        self.honourRetryAfter = honourRetryAfter
+        self.budget = budget
+
+    def delay(self, attempt, previous=None, retryAfter=None):
+        if self.honourRetryAfter and retryAfter is not None:
+            return retryAfter
+
+        if self.jitter == self.DECORRELATED_JITTER:
+            return min(self.cap, random.uniform(self.base, (previous or self.base) * 3))
+
+        _delay = min(self.cap, self.base * (2 ** attempt))
+        if self.jitter == self.FULL_JITTER:
+            return random.uniform(min(self.floor, _delay), _delay)
+        return max(self.floor, _delay)
+
+    def recordRequest(self):
+        if self.budget is not None:
+            self.budget.recordRequest()
+
+    def allowRetry(self):
+        return self.budget is None or self.budget.allowRetry()
+
+    @staticmethod
+    def parseRetryAfter(value):
+        # Retry-After is either delay-seconds or an HTTP-date
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - arrow.utcnow().datetime).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+class SessionJournal:
+    log = structlog.get_logger(__name__)
+
+    def __init__(self, fileName, snapshot, interval=1, maxTextLength=None, codec=None):
+        self.fileName = fileName
+        self.snapshot = snapshot
+        self.interval = interval
+        self.maxTextLength = maxTextLength
+        self.codec = codec or JsonCodec()
+
+        self._dirty = asyncio.Event()
+        self._task = None
+
+    def markDirty(self):
+        # Several updates between two flushes are coalesced into one write
+        self._dirty.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._writer())
+
+    async def _writer(self):
+        while True:
+            await self._dirty.wait()
+            if self.interval:
+                await asyncio.sleep(self.interval)
+            if not await self.flush():
+                # The state is still dirty, don't spin on a failing disk
+                await asyncio.sleep(max(self.interval, 1))
+
+    async def flush(self):
+        if not self._dirty.is_set():
+            return True
+
+        self._dirty.clear()
+        try:
+            contents = self.snapshot()
+            text = contents.get("lastText")
+            # Raw response bytes are journaled as they came in, without re-encoding
+            if isinstance(text, bytes):
+                text = text.decode("utf-8", errors="replace")
+            elif text is not None and not isinstance(text, str):
+                text = self.codec.dumps(text)
+            if self.maxTextLength is not None and text is not None and len(text) > self.maxTextLength:
+                text = text[:self.maxTextLength]
+            if "lastText" in contents:
+                contents["lastText"] = text
+            await writeFileAtomic(self.fileName, self.codec.dumps(contents))
+            return True
+
+        except asyncio.CancelledError:
+            # Interrupted by close(), which flushes again and must still find the state dirty
+            self._dirty.set()
+            raise
+
+        except Exception as e:
+            self.log.error(f"Exception in SessionJournal flush", filename=self.fileName, error=e)
+            self._dirty.set()
+            return False
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+async def writeFileAtomic(filename, text):
+    # Write to a temp file next to the target and rename it into place, every write
+    # gets its own temp file so concurrent writers can't interleave on it
+    tmpFileName = f"{filename}.{uuid.uuid4().hex}.tmp"
+    try:
+        async with aiofiles.open(tmpFileName, mode="w", encoding="utf-8") as f:
+            await f.write(text)
+        await aiofiles.os.replace(tmpFileName, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmpFileName)
+        raise
+
+
+class SessionRegistry:
+    log = structlog.get_logger(__name__)
+
+    DEFAULT_OPTIONS = {"limit": 100,
+                       "limitPerHost": 10,
+                       "keepaliveTimeout": 60,
+                       "ttlDnsCache": 300,
+                       "timeout": None,
+                       "compress": True}
+
+    _options = {}
+    _connectors = {}
+    _sslContext = None
+
+    @classmethod
+    def configure(cls, vendor, **options):
+        cls._options[vendor] = {**cls.DEFAULT_OPTIONS, **options}
+
+    @classmethod
+    def sslContext(cls):
+        # Building a default context loads the CA bundle, do it once for all connectors
+        if cls._sslContext is None:
+            cls._sslContext = ssl.create_default_context()
+        return cls._sslContext
+
+    @classmethod
+    def getConnector(cls, vendor):
+        # Every vendor gets its own connector so LAN devices can't starve cloud APIs of connections
+        connector = cls._connectors.get(vendor)
+        if connector is None or connector.closed:
+            options = cls._options.get(vendor, cls.DEFAULT_OPTIONS)
+            connector = aiohttp.TCPConnector(limit=options["limit"],
+                                             limit_per_host=options["limitPerHost"],
+                                             keepalive_timeout=options["keepaliveTimeout"],
+                                             ttl_dns_cache=options["ttlDnsCache"],
+                                             use_dns_cache=True,
+                                             ssl=cls.sslContext())
+            cls._connectors[vendor] = connector
+            cls.log.debug(f"created connector for {vendor}", options=options)
+        return connector
+
+    @classmethod
+    def getSession(cls, vendor):
+        # Each handler owns its session and cookie jar, closing it leaves the shared connector
+        # and the requests of other handlers of the vendor alone
+        options = cls._options.get(vendor, cls.DEFAULT_OPTIONS)
+        headers = {}
+        if options["compress"]:
+            headers["Accept-Encoding"] = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+        timeout = aiohttp.ClientTimeout(total=options["timeout"]) if options["timeout"] else aiohttp.client.DEFAULT_TIMEOUT
+        return aiohttp.ClientSession(connector=cls.getConnector(vendor), connector_owner=False, headers=headers, timeout=timeout)
+
+    @classmethod
+    async def close(cls, vendor=None):
+        for _vendor in [vendor] if vendor is not None else list(cls._connectors):
+            connector = cls._connectors.pop(_vendor, None)
+            if connector is not None and not connector.closed:
+                await connector.close()
+
 
 class APISessionHandler:
     log = structlog.get_logger(__name__)
@@ -26,7 +747,7 @@ class APISessionHandler:
     def __init__(self):
         pass
 
-    def __init__(self, name, tokenFileName, lastSessionFileName, headers, RETRIES, RETRY_DELAY, THROTTLE_DELAY, THROTTLE_ERROR_DELAY, loginUrls, MAX_CALLS=None, TIMEFRAME_MAX_CALLS=None, logoutUrls=None, BASE_URL=None, refreshUrls=None, data=None, auth=None, commonSession=None):
+    def __init__(self, name, tokenFileName, lastSessionFileName, headers, RETRIES, RETRY_DELAY, THROTTLE_DELAY, THROTTLE_ERROR_DELAY, loginUrls, MAX_CALLS=None, TIMEFRAME_MAX_CALLS=None, logoutUrls=None, BASE_URL=None, refreshUrls=None, data=None, auth=None, commonSession=None, JOURNAL_INTERVAL=1, JOURNAL_MAX_TEXT=None, rateLimiter=None, MAX_IN_FLIGHT=None, REFRESH_MARGIN=None, REFRESH_JITTER=30, HEDGE_DELAY=None, HEDGE_PERCENTILE=95, BREAKER_FAILURES=3, BREAKER_RESET_TIMEOUT=60, onBreakerStateChange=None, codec=None, retryPolicy=None, REQUEST_TIMEOUT=None, connectivity=None, vendor=None, connectorOptions=None, WARM_UP=False, WARM_CONNECTIONS=1, KEEP_WARM_INTERVAL=None):
         self.name = name
         self.tokenFileName = tokenFileName
         self.lastSessionFileName = lastSessionFileName
@@ -38,6 +759,14 @@ class APISessionHandler:
         self.THROTTLE_ERROR_DELAY = THROTTLE_ERROR_DELAY
         self.MAX_CALLS = MAX_CALLS
         self.TIMEFRAME_MAX_CALLS = TIMEFRAME_MAX_CALLS
+        self.REFRESH_MARGIN = REFRESH_MARGIN
+        self.REFRESH_JITTER = REFRESH_JITTER
+        self.HEDGE_DELAY = HEDGE_DELAY
+        self.HEDGE_PERCENTILE = HEDGE_PERCENTILE
+        self.REQUEST_TIMEOUT = REQUEST_TIMEOUT
+        self.WARM_UP = WARM_UP
+        self.WARM_CONNECTIONS = WARM_CONNECTIONS
+        self.KEEP_WARM_INTERVAL = KEEP_WARM_INTERVAL
         self.loginUrls = loginUrls or []
         self.logoutUrls = logoutUrls or []
         # self.BASE_URL = BASE_URL
@@ -45,8 +774,16 @@ class APISessionHandler:
         self.refreshUrls = refreshUrls or []
         self.auth = auth
         self.commonSession = commonSession
+        self.connectivity = connectivity or ConnectivityMonitor.default()
+        self.vendor = vendor or type(self).__name__
+        if connectorOptions is not None:
+            SessionRegistry.configure(self.vendor, **connectorOptions)
+        self.codec = codec if isinstance(codec, JsonCodec) else JsonCodec(codec)
+        # The fixed RETRY_DELAY between attempts unless the vendor passes its own policy
+        self.retryPolicy = retryPolicy or RetryPolicy(maxAttempts=RETRIES, base=RETRY_DELAY, cap=RETRY_DELAY, jitter=None)
 
         self.doSessionLock = asyncio.Lock()
+        self.inFlight = asyncio.Semaphore(MAX_IN_FLIGHT) if MAX_IN_FLIGHT else None
         self.loginLock = asyncio.Lock()
         self.validateLock = asyncio.Lock()
         self.fileLock = asyncio.Lock()
@@ -55,7 +792,25 @@ class APISessionHandler:
         self.refreshTokenExpires = None
         self.lastWorkingUrl = None
         self.session = None
-        self.callTimes = deque()
+        self.loginTask = None
+        self.authGeneration = 0
+        self.backgroundTasks = set()
+        self.latencies = deque(maxlen=100)
+        self.coalescedRequests = {}
+        self.endpointHealth = EndpointHealth(name, self._probeEndpoint, self._startBackgroundTask, BREAKER_FAILURES, BREAKER_RESET_TIMEOUT, onBreakerStateChange)
+        self.lastSessionTime = None
+        self.lastStatus = None
+        self.lastUrl = None
+        self.lastText = None
+        self.rateLimiter = rateLimiter
+        # A limiter passed in may be shared with other handlers, its call history isn't ours to restore or journal
+        self.ownRateLimiter = rateLimiter is None
+        if self.rateLimiter is None:
+            if MAX_CALLS and TIMEFRAME_MAX_CALLS:
+                self.rateLimiter = RateLimiter(MAX_CALLS, TIMEFRAME_MAX_CALLS, name=name)
+            elif THROTTLE_DELAY > 0:
+                self.rateLimiter = RateLimiter(1, THROTTLE_DELAY, name=name)
+        self.journal = SessionJournal(lastSessionFileName, self._sessionState, JOURNAL_INTERVAL, JOURNAL_MAX_TEXT, self.codec) if lastSessionFileName else None
 
     @classmethod
     async def create(cls, *args, **params):
@@ -67,6 +822,13 @@ class APISessionHandler:
             # instance._session = params.pop("commonSession", None)
             # instance.session = await instance._init_session()
             await instance._initSession()
+            await instance._loadSessionState()
+            if instance.WARM_UP:
+                await instance.warmUp()
+            if instance.KEEP_WARM_INTERVAL:
+                instance._startBackgroundTask(instance._keepWarm())
+            if instance.REFRESH_MARGIN is not None:
+                instance._startBackgroundTask(instance._tokenRefresher())
             # return cls._instances[cls]
             return instance
 
@@ -109,29 +871,14 @@ class APISessionHandler:
             self.log.error(f"Exception in create", error=e)
     '''
 
-    async def internetUP(self, retries=5, delay=5):
-        out = False
-        for attempt in range(retries):
-            try:
-                async with aiohttp.ClientSession() as _session:
-                    async with _session.get('http://google.com') as resp:
-                        if resp.status == 200:
-                            self.log.info("Internet connection is up")
-                            out = True
-
-                return out
-
-            except aiohttp.ClientConnectionError:
-                self.log.warning(f"Attempt {attempt + 1}/{retries} failed; retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-
-        self.log.error("Failed to create session: network is unavailable.")
+    async def internetUP(self):
+        return await self.connectivity.isUp()
 
     async def _initSession(self):
         try:
             if self.session is None or self.session.closed:
                 if await self.internetUP():
-                    self.session = self.commonSession if self.commonSession is not None else aiohttp.ClientSession()
+                    self.session = self.commonSession if self.commonSession is not None else SessionRegistry.getSession(self.vendor)
 
         except Exception as e:
             self.log.error(f"Exception in _init_session", error=e)
@@ -159,193 +906,466 @@ class APISessionHandler:
     async def localPreDoSession(self, param):
         pass
 
-    async def doSession(self, internalCall=False, skipThrottle=False, **kwargs):
-
-        async def _writeSessionFile(url, status, text):
+    def streamSession(self, itemPath, maxBuffered=64, **kwargs):
+        # async for item in handler.streamSession(path, ...), stream.result holds the rest of the
+        # document afterwards, or None when the request failed
+        stream = JsonStream(itemPath, maxBuffered)
+        stream.task = asyncio.create_task(self.doSession(stream=stream, **kwargs))
+        return stream
+
+    async def doSession(self, internalCall=False, skipThrottle=False, hedge=False, retryPolicy=None, deadline=None, coalesceKey=None, stream=None, **kwargs):
+
+        if coalesceKey is not None and stream is None:
+            # Identical concurrent read requests share one request on the wire. The shared request
+            # runs without a deadline, every caller waits for it only as long as its own deadline allows
+            _key = (coalesceKey, retryPolicy)
+            shared = self.coalescedRequests.get(_key)
+            if shared is None:
+                shared = asyncio.ensure_future(self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, hedge=hedge, retryPolicy=retryPolicy, **kwargs))
+                self.coalescedRequests[_key] = shared
+                shared.add_done_callback(lambda _: self.coalescedRequests.pop(_key, None))
+            else:
+                self.log.debug(f"{self.name} joining in-flight request")
+            try:
+                return await Deadline.of(deadline).run(asyncio.shield(shared))
+            except DeadlineExceeded:
+                self.log.warning(f"{self.name} deadline exceeded", url=kwargs.get("url"))
+                return None
+
+        async def _holdLock():
+            nonlocal _lockHeld
+            if _serialized and not _lockHeld:
+                await _deadline.run(self.doSessionLock.acquire())
+                _lockHeld = True
+
+        def _releaseLock():
+            nonlocal _lockHeld
+            if _lockHeld:
+                self.doSessionLock.release()
+                _lockHeld = False
+
+        def _writeSessionFile(url, status, text):
             try:
                 _now = arrow.now(self.TIME_ZONE)
+                self.lastSessionTime = _now
+                self.lastStatus = status
+                self.lastUrl = url
+                self.lastText = text
 
-                if self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS:
-                    self.callTimes.append(_now)
-                    # Remove timestamps that are outside the current timeframe
-                    # while self.callTimes and (_now - self.callTimes[0]).total_seconds() > self.TIMEFRAME_MAX_CALLS:
-                    #    self.callTimes.popleft()
-
-                    await self._writeFileAsync(self.lastSessionFileName, {"lastSessionTime": _now.format(self.DATE_FORMAT),
-                                                                          "lastStatus": status,
-                                                                          "lastUrl": url,
-                                                                          "lastText": text,
-                                                                          "callTimes": [ts.format(self.DATE_FORMAT) for ts in self.callTimes or []]})
-                else:
-                    await self._writeFileAsync(self.lastSessionFileName, {"lastSessionTime": _now.format(self.DATE_FORMAT),
-                                                                          "lastStatus": status,
-                                                                          "lastUrl": url,
-                                                                          "lastText": text})
+                if self.journal is not None:
+                    self.journal.markDirty()
 
             except Exception as e:
                 self.log.error(f"Exception in _writeSessionFile", error=e)
 
         async def _waitForThrottle():
             try:
-                _now = arrow.now(self.TIME_ZONE)
-                if self.lastSessionFileName:
-                    lastSessionData = await self._readFileAsync(self.lastSessionFileName)
-                    if lastSessionData:
-                        if self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS:
-                            self.callTimes = deque([arrow.get(ts, tzinfo=self.TIME_ZONE) for ts in lastSessionData.get("callTimes", [])])
-                            # Remove timestamps that are outside the current timeframe
-                            while self.callTimes and (_now - self.callTimes[0]).total_seconds() > self.TIMEFRAME_MAX_CALLS:
-                                self.callTimes.popleft()
-
-                            # Check if the number of calls exceeds the maximum allowed
-                            if len(self.callTimes) >= self.MAX_CALLS:
-                                nextCallTime = self.callTimes[0].shift(seconds=self.TIMEFRAME_MAX_CALLS)
-                                delaySeconds = (nextCallTime - _now).total_seconds()
-                                self.log.info(f"{self.name} waiting {int(delaySeconds)} seconds due to rate limiting", lencallTimes=len(self.callTimes))
-                                await asyncio.sleep(delaySeconds)
-                                # self.callTimes.clear()
-
-                        elif self.THROTTLE_DELAY > 0:
-                            lastSessionTime = arrow.get(lastSessionData.get("lastSessionTime"), tzinfo=self.TIME_ZONE)
-                            lastStatus = lastSessionData.get("lastStatus")
-                            delay = self.THROTTLE_ERROR_DELAY if lastStatus == 429 else self.THROTTLE_DELAY
-                            nextCallTime = lastSessionTime.shift(seconds=delay)
-                            if nextCallTime > _now:
-                                delaySeconds = (nextCallTime - _now).total_seconds()
-                                self.log.info(f"{self.name} waiting {int(delaySeconds)} seconds before next call")
-                                await asyncio.sleep(delaySeconds)
-
+                if self.rateLimiter is not None:
+                    if skipThrottle:
+                        self.rateLimiter.record()
                     else:
-                        self.log.warning(f"{self.name} lastsessionfile damaged or missing")
+                        await _deadline.run(self.rateLimiter.acquire())
+
+            except DeadlineExceeded:
+                raise
 
             except Exception as e:
                 self.log.error(f"Exception in _waitForThrottle", error=e)
 
+        async def _sendRequest(url):
+            _kwargs = dict(kwargs)
+            _kwargs["url"] = self.BASE_URL.join(URL(url)) if self.BASE_URL is not None else URL(url)
+            _kwargs["headers"] = self.headers
+            if self.REQUEST_TIMEOUT is not None and "timeout" not in _kwargs:
+                _kwargs["timeout"] = aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
+            newKwargs = await self.localPreDoSession(_kwargs)
+            _kwargs = newKwargs if newKwargs is not None else _kwargs
+            self.log.debug(f"{self.name} preforming request to {_kwargs.get('url')}")
+            # Ensure shared session is initialized
+            await self._initSession()
+            _slot = self.inFlight
+            if _slot is not None:
+                await _slot.acquire()
+            try:
+                _start = time.monotonic()
+                try:
+                    async with self.session.request(**_kwargs) as response:
+                        content_type = response.headers.get('Content-Type', '').lower()
+                        _streaming = stream is not None and 200 <= response.status < 300 and 'application/json' in content_type
+                        # A streamed body is timed to its headers, the consumer sets the pace after that
+                        raw = await response.read() if not _streaming else None
+                        _latency = time.monotonic() - _start
+                        self.connectivity.reportSuccess()
+                        self.latencies.append(_latency)
+                        self.endpointHealth.recordResponse(url, _latency, response.status)
+                        if _streaming:
+                            # Other requests of this handler must not wait for a slow consumer
+                            _releaseLock()
+                            if _slot is not None:
+                                _slot.release()
+                                _slot = None
+                            result = await stream.consume(response.content, self.codec)
+                        elif 200 <= response.status < 300 and 'application/json' in content_type:
+                            result = self.codec.loads(raw)
+                        else:
+                            result = raw.decode(response.get_encoding(), errors="replace")
+                        return Response(response.status, content_type, result, _kwargs.get('url').human_repr(), raw,
+                                        RetryPolicy.parseRetryAfter(response.headers.get("Retry-After")))
+
+                except Exception as e:
+                    self.endpointHealth.recordFailure(url)
+                    if isinstance(e, aiohttp.ClientConnectionError):
+                        self.connectivity.reportFailure()
+                    raise
+
+            finally:
+                if _slot is not None:
+                    _slot.release()
+
+        def _isGoodResponse(response):
+            return 200 <= response.status < 300 and 'application/json' in response.content_type and (not _urlPool or self.localUrlPoolCheck(response.result))
+
+        async def _sendHedged(urls, index):
+            # Fire the same request at the next url if the first one is slower than usual,
+            # the first good answer wins and the other request is cancelled
+            primary = asyncio.create_task(_sendRequest(urls[index]))
+            tasks = {primary: urls[index]}
+            try:
+                done, _ = await asyncio.wait({primary}, timeout=self._hedgeDelay())
+                if done or not self.endpointHealth.breaker(urls[index + 1]).allowRequest():
+                    return urls[index], await primary
+
+                self.log.debug(f"{self.name} hedging request to {urls[index + 1]}")
+                await _waitForThrottle()
+                tasks[asyncio.create_task(_sendRequest(urls[index + 1]))] = urls[index + 1]
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None and _isGoodResponse(task.result()):
+                            return tasks[task], task.result()
+
+                return urls[index], primary.result()
+
+            finally:
+                # Nothing may stay in flight once we return, are cancelled or run out of time
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+
+        def _retryDelay(attempt, retryAfter=None):
+            nonlocal _previousDelay
+            _previousDelay = _policy.delay(attempt, _previousDelay, retryAfter)
+            return _previousDelay
+
         async def _innerDoSession():
-            nonlocal kwargs
-            for attempt in range(self.RETRIES):
+            for attempt in range(_policy.maxAttempts):
+                if attempt > 0 and not _policy.allowRetry():
+                    self.log.error(f"{self.name} retry budget exhausted, giving up after attempt {attempt}")
+                    return None
+                # A streamed attempt gave the lock up once its headers arrived
+                await _holdLock()
+
+                status = 500  # Default to 500 if no response is received
+                url = _urls[0]
                 try:
                     if not skipThrottle:
-                        await _waitForThrottle()
                         if not await self._tokenValid():
-                            if not await self.login(internalCall=True):
+                            if not await _deadline.run(self._singleFlightLogin()):
                                 return None
 
-                    for index, url in enumerate(_urls):
-                        kwargs["url"] = self.BASE_URL.join(URL(url)) if self.BASE_URL is not None else URL(url)
-                        kwargs["headers"] = self.headers
-                        newKwargs = await self.localPreDoSession(kwargs)
-                        kwargs = newKwargs if newKwargs is not None else kwargs
-                        self.log.debug(f"{self.name} preforming request to {kwargs.get('url')}")
-                        # Ensure shared session is initialized
-                        await self._initSession()
-                        async with self.session.request(**kwargs) as response:
-                            if 200 <= response.status < 300:
-                                content_type = response.headers.get('Content-Type', '').lower()
-                                if 'application/json' in content_type:
-                                    result = await response.json()
-                                    await _writeSessionFile(kwargs.get('url').human_repr(), response.status, ujson.dumps(result))
-                                    if not _urlPool or self.localUrlPoolCheck(result):
-                                        self.lastWorkingUrl = url
-                                        return result
-                                    if index == len(_urls) - 1:  # last item
-                                        self.log.warning(f"{self.name} failed with urlPool attempt {attempt+1}, retrying in {self.RETRY_DELAY} seconds...")
-                                        await asyncio.sleep(self.RETRY_DELAY)
-                                else:
-                                    self.log.error(f"{self.name} received unexpected content type: {content_type}. Expected 'application/json'. Response text: {await response.text()}")
-                                    await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                    if index == len(_urls) - 1:
-                                        await asyncio.sleep(self.RETRY_DELAY)
-
-                            elif response.status == 401:
-                                self.log.warning(f"{self.name} 401 unauthorized attempt {attempt+1}")
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                if not self.loginLock.locked():
-                                    if not await self.login(internalCall=True, forceLogin=True):
+                    _ordered = self.endpointHealth.order(_urls)
+                    if not _ordered:
+                        self.log.error(f"{self.name} all circuits open, failing fast", states=self.endpointHealth.states())
+                        return None
+
+                    for index, url in enumerate(_ordered):
+                        if not self.endpointHealth.breaker(url).allowRequest():
+                            continue
+                        # A streamed response from the previous url may have given the lock up
+                        await _holdLock()
+                        await _waitForThrottle()
+                        _authGeneration = self.authGeneration
+                        if _hedge and index < len(_ordered) - 1:
+                            url, response = await _deadline.run(_sendHedged(_ordered, index))
+                        else:
+                            response = await _deadline.run(_sendRequest(url))
+                        status, content_type, result, _url = response.status, response.content_type, response.result, response.url
+
+                        if 200 <= status < 300:
+                            if 'application/json' in content_type:
+                                _writeSessionFile(_url, status, response.raw)
+                                if not _urlPool or self.localUrlPoolCheck(result):
+                                    self.lastWorkingUrl = url
+                                    return result
+                                if index == len(_ordered) - 1:  # last item
+                                    _delay = _retryDelay(attempt)
+                                    self.log.warning(f"{self.name} failed with urlPool attempt {attempt+1}, retrying in {_delay:.1f} seconds...")
+                                    await _deadline.sleep(_delay)
+                            else:
+                                self.log.error(f"{self.name} received unexpected content type: {content_type}. Expected 'application/json'. Response text: {result}")
+                                _writeSessionFile(_url, status, result)
+                                if index == len(_ordered) - 1:
+                                    await _deadline.sleep(_retryDelay(attempt))
+
+                        elif status == 401:
+                            self.log.warning(f"{self.name} 401 unauthorized attempt {attempt+1}")
+                            _writeSessionFile(_url, status, result)
+                            if not _inLogin.get():
+                                # Someone else already logged in after this request was sent
+                                if _authGeneration == self.authGeneration:
+                                    if not await _deadline.run(self._singleFlightLogin(forceLogin=True)):
                                         return None
-                                    self.log.warning(f"{self.name} retrying request attempt {attempt+1} in {self.RETRY_DELAY} seconds...")
-                                    await asyncio.sleep(self.RETRY_DELAY)
-                                    break
-
-                            elif response.status == 404:
-                                self.log.error(f"{self.name} 404 not found attempt {attempt+1}")
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                return
-
-                            elif response.status == 429:
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                self.log.warning(f"{self.name} 429 too many requests attempt {attempt+1}, retrying after {self.RETRY_DELAY} seconds...", callTimes=self.callTimes)
-                                await asyncio.sleep(self.RETRY_DELAY)
+                                self.log.warning(f"{self.name} retrying request attempt {attempt+1} with new credentials")
                                 break
 
+                        elif status == 404:
+                            self.log.error(f"{self.name} 404 not found attempt {attempt+1}")
+                            _writeSessionFile(_url, status, result)
+                            return
+
+                        elif status == 429:
+                            _writeSessionFile(_url, status, result)
+                            _delay = _retryDelay(attempt, response.retryAfter)
+                            # Hold back every caller sharing the limiter, not just this one. The server's
+                            # Retry-After replaces the fixed THROTTLE_ERROR_DELAY when it is honoured
+                            if response.retryAfter is not None and _policy.honourRetryAfter:
+                                if self.rateLimiter is not None:
+                                    self.rateLimiter.penalize(response.retryAfter)
                             else:
-                                self.log.error(f"{self.name} request failed with status {response.status} attempt {attempt+1} retrying in {self.RETRY_DELAY} seconds...", url=kwargs.get('url'), params=kwargs.get("params"))
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                await asyncio.sleep(self.RETRY_DELAY)
+                                # Without a Retry-After never back off less than the fixed delays did
+                                _delay = max(_delay, self.RETRY_DELAY)
+                                if self.rateLimiter is None:
+                                    _delay = max(_delay, self.THROTTLE_ERROR_DELAY)
+                                elif not (self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS):
+                                    self.rateLimiter.penalize(self.THROTTLE_ERROR_DELAY)
+                            self.log.warning(f"{self.name} 429 too many requests attempt {attempt+1}, retrying after {_delay:.1f} seconds...", retryAfter=response.retryAfter)
+                            await _deadline.sleep(_delay)
+                            break
+
+                        else:
+                            _delay = _retryDelay(attempt, response.retryAfter)
+                            self.log.error(f"{self.name} request failed with status {status} attempt {attempt+1} retrying in {_delay:.1f} seconds...", url=_url, params=kwargs.get("params"))
+                            _writeSessionFile(_url, status, result)
+                            await _deadline.sleep(_delay)
+
+                except DeadlineExceeded:
+                    raise
 
                 except aiohttp.ClientConnectionError as e:
-                    _delay = min(self.RETRY_DELAY * (2 ** attempt), self.RETRY_DELAY * (2 ** self.RETRIES))
-                    _status = response.status if 'response' in locals() else 500  # Default to 500 if response is not defined
-                    self.log.error(f"{self.name} ClientConnectionError attempt {attempt+1} retrying in {_delay} seconds...", error=e, url=kwargs.get('url'), params=kwargs.get("params"))
-                    await _writeSessionFile(url, _status, f"{type(e).__name__}: {str(e)}")
-                    await asyncio.sleep(_delay)
-                    # reset sessionen bara och det inte är en gemensam session
-                    if self.commonSession is None:
+                    _delay = _retryDelay(attempt)
+                    self.log.error(f"{self.name} ClientConnectionError attempt {attempt+1} retrying in {_delay:.1f} seconds...", error=e, url=url, params=kwargs.get("params"))
+                    _writeSessionFile(url, status, f"{type(e).__name__}: {str(e)}")
+                    await _deadline.sleep(_delay)
+                    # reset sessionen bara och det inte är en gemensam session, and only when
+                    # no other request of this handler can be in flight on it
+                    if self.commonSession is None and self.inFlight is None:
                         await self.closeSession()
 
                 except Exception as e:
-                    self.log.error(f"{self.name} Exception in _innerDoSession attempt {attempt+1} retrying in {self.RETRY_DELAY} seconds...", url=kwargs.get('url'), params=kwargs.get("params"))
-                    await _writeSessionFile(url, 999, f"{type(e).__name__}: {str(e)}")
-                    await asyncio.sleep(self.RETRY_DELAY)
+                    _delay = _retryDelay(attempt)
+                    self.log.error(f"{self.name} Exception in _innerDoSession attempt {attempt+1} retrying in {_delay:.1f} seconds...", error=e, url=url, params=kwargs.get("params"))
+                    _writeSessionFile(url, 999, f"{type(e).__name__}: {str(e)}")
+                    await _deadline.sleep(_delay)
 
             self.log.error(f"{self.name} _innerDoSession max retries reached")
 
         _urls = kwargs.pop("url")
         _urls = _urls if isinstance(_urls, list) else [_urls]
         _urlPool = len(_urls) > 1
+        _hedge = hedge and _urlPool and self.HEDGE_DELAY is not None and stream is None
+        _policy = retryPolicy or self.retryPolicy
+        _deadline = Deadline.of(deadline)
+        _policy.recordRequest()
+        _previousDelay = None
+        _serialized = not internalCall and self.inFlight is None
+        _lockHeld = False
 
-        if _urlPool and self.lastWorkingUrl:
-            if skipThrottle:
-                if self.lastWorkingUrl in self.loginUrls:
-                    self.loginUrls = self._moveToFront(self.lastWorkingUrl, self.loginUrls)
+        try:
+            # In concurrent mode only the request itself holds an inFlight slot,
+            # throttle waits, retry delays and logins run outside of it
+            try:
+                await _holdLock()
+                return await _innerDoSession()
+            finally:
+                _releaseLock()
 
-                elif self.lastWorkingUrl in self.refreshUrls:
-                    self.refreshUrls = self._moveToFront(self.lastWorkingUrl, self.refreshUrls)
+        except DeadlineExceeded:
+            self.log.warning(f"{self.name} deadline exceeded", url=_urls[0])
+            return None
 
-                # elif self.lastWorkingUrl in self.logoutUrls:
-                #    self.logoutUrls = self._moveToFront(self.lastWorkingUrl, self.logoutUrls)
+    async def _probeEndpoint(self, url):
+        try:
+            await self._initSession()
+            _url = self.BASE_URL.join(URL(url)) if self.BASE_URL is not None else URL(url)
+            async with self.session.head(_url, headers=self.headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                return response.status < 500
 
-            elif self.lastWorkingUrl in _urls:
-                _urls = self._moveToFront(self.lastWorkingUrl, _urls)
+        except Exception as e:
+            self.log.debug(f"{self.name} probe of {url} failed", error=e)
+            return False
 
-        if not internalCall:
-            async with self.doSessionLock:
-                return await _innerDoSession()
-        else:
-            return await _innerDoSession()
+    def breakerStates(self):
+        return self.endpointHealth.states()
+
+    def _hedgeDelay(self):
+        # HEDGE_DELAY until there are enough samples, then the HEDGE_PERCENTILE latency
+        if len(self.latencies) < 20:
+            return self.HEDGE_DELAY
+        _sorted = sorted(self.latencies)
+        return _sorted[min(len(_sorted) - 1, int(len(_sorted) * self.HEDGE_PERCENTILE / 100))]
+
+    async def _loadSessionState(self):
+        # The throttle state lives in memory, the lastsessionfile is only read once at startup
+        try:
+            if not self.lastSessionFileName:
+                return
+
+            lastSessionData = await self._readFileAsync(self.lastSessionFileName)
+            if not lastSessionData:
+                self.log.warning(f"{self.name} lastsessionfile damaged or missing")
+                return
+
+            if lastSessionData.get("lastSessionTime"):
+                self.lastSessionTime = arrow.get(lastSessionData.get("lastSessionTime"), tzinfo=self.TIME_ZONE)
+            self.lastStatus = lastSessionData.get("lastStatus")
+
+            if self.rateLimiter is not None:
+                if not self.ownRateLimiter:
+                    if lastSessionData.get("throttledUntil") is not None:
+                        self.rateLimiter.penalize(max(0, lastSessionData["throttledUntil"] - time.time()))
+                elif self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS:
+                    self.rateLimiter.restore([arrow.get(ts, tzinfo=self.TIME_ZONE).timestamp() for ts in lastSessionData.get("callTimes", [])])
+                elif self.lastSessionTime is not None:
+                    self.rateLimiter.restore([self.lastSessionTime.timestamp()])
+                    if lastSessionData.get("throttledUntil") is not None:
+                        self.rateLimiter.penalize(max(0, lastSessionData["throttledUntil"] - time.time()))
+                    elif self.lastStatus == 429:
+                        _remaining = self.lastSessionTime.shift(seconds=self.THROTTLE_ERROR_DELAY) - arrow.now(self.TIME_ZONE)
+                        self.rateLimiter.penalize(max(0, _remaining.total_seconds()))
+
+        except Exception as e:
+            self.log.error(f"Exception in _loadSessionState", error=e)
+
+    def _sessionState(self):
+        contents = {"lastSessionTime": self.lastSessionTime.format(self.DATE_FORMAT) if self.lastSessionTime else None,
+                    "lastStatus": self.lastStatus,
+                    "lastUrl": self.lastUrl,
+                    "lastText": self.lastText}
+
+        if self.rateLimiter is not None and self.ownRateLimiter and self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS:
+            contents["callTimes"] = [arrow.get(ts).to(self.TIME_ZONE).format(self.DATE_FORMAT) for ts in self.rateLimiter.snapshot()]
+        elif self.rateLimiter is not None and self.rateLimiter.penaltyRemaining():
+            # The penalty actually applied after a 429, which may come from Retry-After
+            contents["throttledUntil"] = time.time() + self.rateLimiter.penaltyRemaining()
+
+        return contents
+
+    async def _singleFlightLogin(self, forceLogin=False):
+        # The first caller starts the login, everyone else awaits the same task
+        if self.loginTask is None or self.loginTask.done():
+            self.loginTask = asyncio.create_task(self.login(internalCall=True, forceLogin=forceLogin))
+        return await asyncio.shield(self.loginTask)
 
     async def login(self, internalCall=False, forceLogin=False):
+        _token = _inLogin.set(True)
         try:
             async with self.loginLock:
                 if not forceLogin and await self._getTokenFromFile():
+                    self.authGeneration += 1
                     return True
 
                 if self.refreshUrls and await self._tokenValid(self.refreshTokenExpires):
                     self.log.info(f"{self.name} refreshing token")
                     if await self.localDoRefresh(internalCall=internalCall):
+                        self.authGeneration += 1
                         return True
                 else:
                     self.log.info(f"{self.name} has no refreshUrl or refreshtoken expired")
 
                 self.log.info(f"{self.name} performing login")
                 if await self.localDoLogin(internalCall=internalCall):
+                    self.authGeneration += 1
                     return True
 
         except Exception as e:
             self.log.error(f"Exception in login", error=e)
 
+        finally:
+            _inLogin.reset(_token)
+
     async def logout(self):
         await self.localDoLogout()
+        await self.shutdown()
+
+    async def shutdown(self):
+        for task in list(self.backgroundTasks):
+            task.cancel()
+        await asyncio.gather(*self.backgroundTasks, return_exceptions=True)
+        self.backgroundTasks.clear()
+
+        if self.journal is not None:
+            await self.journal.close()
+
+    def _startBackgroundTask(self, coro):
+        task = asyncio.create_task(coro)
+        self.backgroundTasks.add(task)
+        task.add_done_callback(self.backgroundTasks.discard)
+        return task
+
+    def _warmOrigins(self):
+        # Connections are pooled per scheme, host and port so one request per origin is enough
+        origins = []
+        for url in [self.BASE_URL] if self.BASE_URL is not None else []:
+            origins.append(url.origin())
+        for url in self.loginUrls + self.refreshUrls + self.logoutUrls:
+            _url = self.BASE_URL.join(URL(url)) if self.BASE_URL is not None else URL(url)
+            if _url.is_absolute() and _url.origin() not in origins:
+                origins.append(_url.origin())
+        return origins
+
+    async def warmUp(self):
+        # Open WARM_CONNECTIONS keep-alive connections to every host in the url pools
+        try:
+            await self._initSession()
+            origins = self._warmOrigins()
+            results = await asyncio.gather(*[self._probeEndpoint(str(origin)) for origin in origins for _ in range(self.WARM_CONNECTIONS)])
+            self.log.debug(f"{self.name} warmed up connections", origins=[str(origin) for origin in origins], ok=sum(results))
+
+        except Exception as e:
+            self.log.error(f"Exception in warmUp", error=e)
+
+    async def _keepWarm(self):
+        while True:
+            await asyncio.sleep(self.KEEP_WARM_INTERVAL)
+            await self.warmUp()
+
+    async def _tokenRefresher(self):
+        # Renew the token REFRESH_MARGIN seconds (minus jitter) before it expires so
+        # foreground requests never have to wait for authentication
+        while True:
+            try:
+                if self.tokenExpires is not None:
+                    _delay = (self.tokenExpires - arrow.now(self.TIME_ZONE)).total_seconds() - self.REFRESH_MARGIN - random.uniform(0, self.REFRESH_JITTER)
+                    if _delay > 0:
+                        await asyncio.sleep(min(_delay, self.REFRESH_MARGIN or _delay))
+                        continue
+
+                self.log.info(f"{self.name} refreshing token ahead of expiry", tokenExpires=self.tokenExpires)
+                if not await self._singleFlightLogin(forceLogin=self.tokenExpires is not None):
+                    self.log.warning(f"{self.name} background refresh failed, retrying in {self.RETRY_DELAY} seconds...")
+                    await asyncio.sleep(self.RETRY_DELAY)
+
+                elif self.tokenExpires is None or (self.tokenExpires - arrow.now(self.TIME_ZONE)).total_seconds() <= self.REFRESH_MARGIN:
+                    # Token lifetime is shorter than the margin, don't spin on refreshes
+                    await asyncio.sleep(self.RETRY_DELAY)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                self.log.error(f"Exception in _tokenRefresher", error=e)
+                await asyncio.sleep(self.RETRY_DELAY)
 
     async def _tokenValid(self, timecheck=None):
         if self.tokenFileName is not None:
@@ -382,24 +1402,13 @@ class APISessionHandler:
         await self._writeFileAsync(self.tokenFileName, {"token": token,
                                                         "tokenExpires": self.tokenExpires.format(self.DATE_FORMAT)})
 
-    @staticmethod
-    def _moveToFront(item, lst):
-        if not lst or lst[0] == item:
-            # Item is already the first item
-            return lst
-
-        new_lst = lst.copy()
-        new_lst.remove(item)
-        new_lst.insert(0, item)
-        return new_lst
-
     async def _readFileAsync(self, filename):
         async with self.fileLock:
             try:
                 if os.path.exists(filename):
                     async with aiofiles.open(filename, mode="r", encoding="utf-8") as f:
                         _cont = await f.read()
-                        return json.loads(_cont)
+                        return self.codec.loads(_cont)
                 return {}
 
             except Exception as e:
@@ -410,7 +1419,7 @@ class APISessionHandler:
         async with self.fileLock:
             try:
                 async with aiofiles.open(filename, mode="w", encoding="utf-8") as f:
-                    await f.write(json.dumps(contents))
+                    await f.write(self.codec.dumps(contents))
 
             except Exception as e:
                 self.log.error(f"Exception in _writeFileAsync", filename=filename, error=e)
@@ -419,7 +1428,7 @@ class APISessionHandler:
 class APIMelcloud(APISessionHandler):
 
     async def localDoLogin(self, internalCall, skipThrottle=True):
-        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="POST", url=self.loginUrls, data=ujson.dumps(self.data))
+        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="POST", url=self.loginUrls, data=self.codec.dumps(self.data))
         if out is not None and 'LoginData' in out and 'ContextKey' in out['LoginData']:
             self.log.info(f"{self.name} login success")
             _token = out['LoginData']['ContextKey']
@@ -462,7 +1471,7 @@ class APIEnegic(APISessionHandler):
             self.log.info(f"{self.name} data['Token'] is None")
             return
 
-        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="PUT", url=self.refreshUrls, data=ujson.dumps(data))
+        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="PUT", url=self.refreshUrls, data=self.codec.dumps(data))
         if out is not None and 'TokenInfo' in out:
             self.log.info(f"{self.name} refresh success")
             _token = out["TokenInfo"]["Token"]
@@ -475,7 +1484,7 @@ class APIEnegic(APISessionHandler):
             self.log.warning(f"{self.name} refresh failed no accesstoken in reply")
 
     async def localDoLogin(self, internalCall, skipThrottle=True):
-        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="PUT", url=self.loginUrls, data=ujson.dumps(self.data))
+        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="PUT", url=self.loginUrls, data=self.codec.dumps(self.data))
         if out is not None and 'TokenInfo' in out:
             self.log.info(f"{self.name} login success")
             _token = out["TokenInfo"]["Token"]
@@ -565,7 +1574,7 @@ class APITelldusLocal(APISessionHandler):
             self.log.warning(f"{self.name} refresh failed no accesstoken in reply")
 
     async def localDoLogin(self, internalCall, skipThrottle=True):
-        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="PUT", url=self.loginUrls, data=ujson.dumps(self.data))
+        out = await self.doSession(internalCall=internalCall, skipThrottle=skipThrottle, method="PUT", url=self.loginUrls, data=self.codec.dumps(self.data))
         if out is not None and 'TokenInfo' in out:
             self.log.info(f"{self.name} login success")
             _token = out["token"]